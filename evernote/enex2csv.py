@@ -6,42 +6,72 @@ enex2csv.py [-h] --input-file ENEXFILE --output-file CSVFILE [--use-markdown]
 """
 
 import argparse
+import contextlib
 import csv
 import datetime
+import functools
 import logging
+import os
+import re
+import stat
 import sys
+import tempfile
+import textwrap
 
 from dateutil.parser import isoparse
 from html2text import HTML2Text
+from html2text import config as html2text_config
 from lxml import etree
 
-logger = None
+logger = logging.getLogger(__name__)
+
+FIELDNAMES = (
+    "title",
+    "description",
+    "url",
+    "created",
+    "updated_date",
+    "reminder_date",
+    "tags",
+)
+
+# Year substituted into ENEX dates exported with a "0000" year.
+CURRENT_YEAR = str(datetime.datetime.now(datetime.timezone.utc).year)
+
+# Compact UTC timestamp ENEX uses for note dates, e.g. "20230105T101010Z".
+ENEX_DATE_RE = re.compile(r"(\d{4})(\d{2})(\d{2})T([01]\d|2[0-3])(\d{2})(\d{2})Z\Z")
+
+# Write buffer for the CSV, sized so multi-KB note bodies still batch into few writes.
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# ENML body holding nothing but text inside the <en-note> wrapper.
+PLAIN_ENML_RE = re.compile(
+    r"\A\s*(?:<\?xml[^>]*>\s*)?(?:<!DOCTYPE[^>]*>\s*)?"
+    r"<en-note[^>]*>([^<>]*)</en-note>\s*\Z"
+)
+
+# Text that html2text would escape, or refuse to wrap, when rendering Markdown.
+MARKDOWN_SENSITIVE_RE = re.compile(r"[\\`*+|\[\]]|&(?!amp;)|\d\.\s|\A\s*-|-[-\s]")
 
 
 def setup_logging():
     """
     Initilialize console logger and log format.
     """
-    global logger
     log_format = "%(asctime)s | %(levelname)8s | %(message)s"
     handlers = [logging.StreamHandler(stream=sys.stdout)]
     logging.basicConfig(handlers=handlers, level=logging.INFO, format=log_format)
-    logger = logging.getLogger(__name__)
 
 
-def parse_command_line_args(args):
+@functools.lru_cache(maxsize=1)
+def _build_parser():
     """
-    Parse the arguments passed via the command line.
-
-    Parameters
-    ----------
-    args : str
-        Raw command line arguments.
+    Build the command line argument parser.
 
     Returns
     -------
-    argparse.Namespace
-        Parsed command line arguments.
+    argparse.ArgumentParser
+        Configured parser, cached so repeated calls reuse the same instance.
     """
     parser = argparse.ArgumentParser(description="Convert Evernote ENEX file to CSV")
     parser.add_argument(
@@ -63,7 +93,24 @@ def parse_command_line_args(args):
         help="Convert note content to Markdown",
         action="store_true",
     )
-    parsed_args = parser.parse_args(args)
+    return parser
+
+
+def parse_command_line_args(args):
+    """
+    Parse the arguments passed via the command line.
+
+    Parameters
+    ----------
+    args : str
+        Raw command line arguments.
+
+    Returns
+    -------
+    argparse.Namespace
+        Parsed command line arguments.
+    """
+    parsed_args = _build_parser().parse_args(args)
     return parsed_args
 
 
@@ -83,8 +130,19 @@ def read_enex(enex_filename):
     """
     logger.info(f'Parsing input file "{enex_filename}"')
     with open(enex_filename, "r", encoding="utf-8") as enex_fd:
+        if hasattr(os, "posix_fadvise"):
+            # Read-ahead hint only; pipes and FIFOs reject it, which is fine.
+            with contextlib.suppress(OSError):
+                os.posix_fadvise(enex_fd.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
         try:
-            xml_parser = etree.XMLParser(huge_tree=True, resolve_entities=False)
+            xml_parser = etree.XMLParser(
+                huge_tree=True,
+                resolve_entities=False,
+                # Also joins text split by a comment, so "x<!-- c -->y" reads as
+                # "xy" rather than just the text before the comment.
+                remove_comments=True,
+                remove_pis=True,
+            )
             xml_tree = etree.parse(enex_fd, xml_parser)
             return xml_tree
         except Exception:
@@ -137,6 +195,13 @@ def html_to_markdown(html):
     str
         Rendered Markdown.
     """
+    plain_match = PLAIN_ENML_RE.match(html)
+    if plain_match and not MARKDOWN_SENSITIVE_RE.search(plain_match.group(1)):
+        # Plain text notes render to the same wrapped paragraph html2text would produce.
+        text = " ".join(plain_match.group(1).replace("&amp;", "&").split())
+        lines = textwrap.wrap(text, html2text_config.BODY_WIDTH, break_long_words=False)
+        return "\n".join(lines) + "\n\n"
+
     converter = HTML2Text()
     converter.mark_code = True
     return converter.handle(html)
@@ -157,14 +222,19 @@ def parse_xml_date(date_str):
         Extracted datetime value.
     """
     if date_str.startswith("0000"):
-        date_str = str(datetime.datetime.utcnow().year) + date_str[4:]
+        date_str = CURRENT_YEAR + date_str[4:]
+    date_match = ENEX_DATE_RE.match(date_str)
+    if date_match:
+        return datetime.datetime(
+            *map(int, date_match.groups()), tzinfo=datetime.timezone.utc
+        )
     date = isoparse(date_str)
     return date
 
 
 def extract_note_records(xml_tree, use_markdown):
     """
-    Extract notes as dictionaries.
+    Extract notes as CSV records.
 
     Parameters
     ----------
@@ -173,14 +243,14 @@ def extract_note_records(xml_tree, use_markdown):
     use_markdown : bool
         Whether to convert note content to Markdown. Otherwise, use raw XML/HTML.
 
-    Returns
-    -------
-    list[dict]
-        Extracted note records.
+    Yields
+    ------
+    tuple
+        Extracted note record, in FIELDNAMES order.
     """
     notes = xml_tree.xpath("//note")
     logger.info(f"Found {len(notes)} notes")
-    records = []
+    converted = 0
 
     for note in notes:
         title = xpath_first_or_default(note, "title", "")
@@ -198,19 +268,75 @@ def extract_note_records(xml_tree, use_markdown):
         if use_markdown:
             content = html_to_markdown(content)
 
-        record = {
-            "title": title,
-            "description": content,
-            "url": source_url,
-            "created": created_date,
-            "updated_date": updated_date,
-            "reminder_date": reminder_date,
-            "tags": tags,
-        }
-        records.append(record)
+        yield (
+            title,
+            content,
+            source_url,
+            created_date,
+            updated_date,
+            reminder_date,
+            tags,
+        )
+        converted += 1
+
+    logger.info(f"{converted} notes converted")
 
-    logger.info(f"{len(records)} notes converted")
-    return records
+
+@contextlib.contextmanager
+def open_output(filename, **open_kwargs):
+    """
+    Open an output file for writing, replacing it only once writing succeeds.
+
+    Regular files (or paths that do not exist yet) are written to a temporary file
+    beside the resolved path, so symlinks keep pointing at the updated target.
+    Anything else (stdout, FIFOs, /proc/self/fd/N) is written directly.
+
+    Parameters
+    ----------
+    filename : str
+        Output file path.
+    **open_kwargs
+        Extra keyword arguments for ``open``.
+
+    Yields
+    ------
+    file object
+        Text file opened for writing.
+    """
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        st = None
+        # A dangling symlink is written through like any other special path.
+        replace = not os.path.lexists(filename)
+    else:
+        replace = stat.S_ISREG(st.st_mode)
+
+    if not replace:
+        with open(filename, "w", **open_kwargs) as out_fd:
+            yield out_fd
+        return
+
+    real_filename = os.path.realpath(filename)
+    if st is not None:
+        mode = stat.S_IMODE(st.st_mode)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    tmp_fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(real_filename), suffix=".tmp"
+    )
+    try:
+        with open(tmp_fd, "w", **open_kwargs) as out_fd:
+            yield out_fd
+        # mkstemp creates the file 0600; give it the mode open() would have.
+        os.chmod(tmp_filename, mode)
+        os.replace(tmp_filename, real_filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_filename)
+        raise
 
 
 def write_csv(csv_filename, note_records):
@@ -221,15 +347,17 @@ def write_csv(csv_filename, note_records):
     ----------
     csv_filename : str
         Output CSV file path.
-    records : list[dict]
-        Extracted note records.
+    records : iterable[tuple]
+        Extracted note records, in FIELDNAMES order, written as they are produced.
+        Notes are converted while writing, so a regular output file is only
+        replaced once every note has converted (see open_output).
     """
     logger.info(f'Writing CSV output to "{csv_filename}"')
-    with open(csv_filename, "w", encoding="utf-8") as csv_fd:
-        writer = csv.DictWriter(
-            csv_fd, fieldnames=list(note_records[0]), delimiter=",", lineterminator="\n"
-        )
-        writer.writeheader()
+    with open_output(
+        csv_filename, encoding="utf-8", newline="", buffering=WRITE_BUFFER_SIZE
+    ) as csv_fd:
+        writer = csv.writer(csv_fd, delimiter=",", lineterminator="\n")
+        writer.writerow(FIELDNAMES)
         writer.writerows(note_records)
 
 
@@ -244,9 +372,6 @@ def convert_enex(parsed_args):
     """
     xml_tree = read_enex(parsed_args.input_file)
     records = extract_note_records(xml_tree, parsed_args.use_markdown)
-    if len(records) < 0:
-        logger.error("No records found to convert")
-        return
     write_csv(parsed_args.output_file, records)
 
 
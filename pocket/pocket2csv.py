@@ -1,14 +1,24 @@
 # parse pocket html export and convert to csv
 
+import contextlib
 import csv
+import functools
 import logging
+import os
+import stat
 import sys
+import tempfile
+import time
 import argparse
-from datetime import datetime
-from bs4 import BeautifulSoup
+from lxml import etree
 
 logger = None
 
+FIELDNAMES = ("title", "url", "created", "tags")
+
+# Bookmark rows are only a few hundred bytes each; buffer 1 MiB of them per write.
+WRITE_BUFFER_SIZE = 1024 * 1024
+
 
 def setup_logging():
     """
@@ -53,41 +63,156 @@ def parse_command_line_args(args):
     return parser.parse_args(args)
 
 
-def convert_html(args):
+@functools.lru_cache(maxsize=4096)
+def format_timestamp(timestamp):
     """
-    Convert Pocket HTML file to CSV.
+    Format a Unix timestamp as local time, the way strftime("%x %X") renders it.
+
+    The scripts never call setlocale, so "%x %X" always uses the C locale
+    format; building the string directly skips strftime's locale handling.
+    Results are cached since items imported into Pocket in bulk share the
+    same time_added.
+
+    Parameters
+    ----------
+    timestamp : float
+        Seconds since the epoch.
 
-    :param args:
-    :return:
+    Returns
+    -------
+    str
+        Date and time as "MM/DD/YY HH:MM:SS".
     """
+    t = time.localtime(timestamp)
+    return "%02d/%02d/%02d %02d:%02d:%02d" % (
+        t.tm_mon, t.tm_mday, t.tm_year % 100, t.tm_hour, t.tm_min, t.tm_sec
+    )
+
+
+def extract_bookmarks(html_fd):
+    """
+    Extract bookmarks from a Pocket export while it is being parsed.
+
+    Parameters
+    ----------
+    html_fd : file
+        Pocket HTML export opened in binary mode.
+
+    Yields
+    ------
+    tuple
+        Bookmark record in FIELDNAMES order, one per list item.
+    """
+    items = etree.iterparse(
+        html_fd, events=("end",), tag="li", html=True, encoding="utf-8"
+    )
+    for _, item in items:
+        for anchor in item.iterfind("a"):
+            url = anchor.get("href")
+            title = anchor.text
+            tags = anchor.get("tags")
+
+            time_added = float(anchor.get("time_added"))
+            date_added = format_timestamp(time_added)
+            yield title, url, date_added, tags
+
+        # Drop list items already converted so memory stays flat on large exports.
+        item.clear()
+        while item.getprevious() is not None:
+            del item.getparent()[0]
+
 
-    csv_rows = []
-    with open(args.input_file, "r") as f:
-        html = f.read()
-    soup = BeautifulSoup(html, "html.parser")
-    with open(args.output_file, "w") as f:
-
-        for item in soup.find_all("li"):
-            url = item.contents[0].get("href")
-            title = item.contents[0].string
-            tags = item.contents[0].get("tags")
-
-            time_added = float(item.contents[0].get("time_added"))
-            date_added = datetime.fromtimestamp(time_added).strftime("%x %X")
-            row = {
-                "title": title,
-                "url": url,
-                "created": date_added,
-                "tags": tags
-            }
-            csv_rows.append(row)
-
-        writer = csv.DictWriter(
-            f, fieldnames=list(csv_rows[0]), delimiter=",", lineterminator="\n", quotechar='"', quoting=csv.QUOTE_ALL
+@contextlib.contextmanager
+def open_output(filename, **open_kwargs):
+    """
+    Open an output file for writing, replacing it only once writing succeeds.
+
+    Behaves like enex2csv.open_output: regular (or not yet existing) outputs go
+    through a temporary file beside the resolved path, everything else such as
+    stdout or a FIFO is written directly.
+
+    Parameters
+    ----------
+    filename : str
+        Output file path.
+    **open_kwargs
+        Extra keyword arguments for ``open``.
+
+    Yields
+    ------
+    file object
+        Text file opened for writing.
+    """
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        st = None
+        replace = not os.path.lexists(filename)
+    else:
+        replace = stat.S_ISREG(st.st_mode)
+
+    if not replace:
+        with open(filename, "w", **open_kwargs) as out_fd:
+            yield out_fd
+        return
+
+    real_filename = os.path.realpath(filename)
+    if st is not None:
+        mode = stat.S_IMODE(st.st_mode)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    tmp_fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(real_filename), suffix=".tmp"
+    )
+    try:
+        with open(tmp_fd, "w", **open_kwargs) as out_fd:
+            yield out_fd
+        os.chmod(tmp_filename, mode)
+        os.replace(tmp_filename, real_filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_filename)
+        raise
+
+
+def write_csv(csv_filename, rows):
+    """
+    Write bookmark records as CSV.
+
+    Parameters
+    ----------
+    csv_filename : str
+        Output CSV file path.
+    rows : iterable[tuple]
+        Bookmark records in FIELDNAMES order, written as they are produced. A
+        malformed bookmark aborts the run without replacing a regular output file.
+    """
+    with open_output(csv_filename, newline="", buffering=WRITE_BUFFER_SIZE) as f:
+        writer = csv.writer(
+            f, delimiter=",", lineterminator="\n", quotechar='"', quoting=csv.QUOTE_ALL
         )
 
-        writer.writeheader()
-        writer.writerows(csv_rows)
+        writer.writerow(FIELDNAMES)
+        writer.writerows(rows)
+
+
+def convert_html(args):
+    """
+    Convert Pocket HTML file to CSV.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed command line arguments.
+    """
+    with open(args.input_file, "rb") as html_fd:
+        if hasattr(os, "posix_fadvise"):
+            # Best-effort read-ahead; not every input (e.g. <(cat export)) is seekable.
+            with contextlib.suppress(OSError):
+                os.posix_fadvise(html_fd.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        write_csv(args.output_file, extract_bookmarks(html_fd))
 
 
 def main():